@@ -1,25 +1,145 @@
 import praw
+from prawcore.exceptions import PrawcoreException, RequestException, ServerError, TooManyRequests
 from cryptography.fernet import Fernet
 import base64
 import json
 import time # for timing experiments
-from typing import Tuple, List, Any, Generator, Iterable
-from itertools import chain
-from joblib import Parallel, delayed
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from operator import attrgetter
+from typing import Tuple, List, Any, Iterable, Generator, Optional, Callable
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, local
 import os
 import re
 import sqlite3
+import tempfile
+from urllib.request import pathname2url
+from Database_transaction import transaction
 
 post_columns_global = ['Id', 'Title', 'Author', 'Author_flair', 'Created', 'Text',
                 'Text_content', 'Num_comments', 'Score', 'Upvote_ratio', 'Stickied', 'Distinguished', 'URL']
 comment_columns_global = ['Id', 'Author', 'Created', 'Submission_id', 'Text_content', 'Num_replies', 'Score', 'Stickied', 'Distinguished']
 reply_columns_global = ['Id', 'Author', 'Created', 'Submission_id', 'Parent_id', 'Text_content', 'Score', 'Stickied', 'Distinguished']
 table_names = ('Posts', 'Comments', 'Replies')
+credential_fields = ('client_id', 'client_secret', 'refresh_token')
+# column lists in the order Posts, Comments, Replies - tables are matched by position, so they can have other names
+table_columns_global = (post_columns_global, comment_columns_global, reply_columns_global)
+# columns refreshed when a row with an existing Id arrives from a newer snapshot, other columns keep their first values
+upsert_columns_global = (('Num_comments', 'Score', 'Upvote_ratio'),
+                         ('Num_replies', 'Score'),
+                         ('Score',))
 
 #api limits
 max_posts_per_request = 100 # current praw limit
 api_requests_limit = 600 # current limit of api requests in one time frame.
 praw_posts_limit = (api_requests_limit * max_posts_per_request + 1) // (max_posts_per_request + 1)
+# attributes read from PRAW objects by process_posts, attrgetter fetches all of them in one C-level call
+post_fields_getter = attrgetter('id', 'title', 'author', 'author_flair_text', 'created_utc', 'is_self', 'selftext',
+                                'num_comments', 'score', 'upvote_ratio', 'stickied', 'distinguished', 'url')
+comment_fields_getter = attrgetter('id', 'author', 'created_utc', 'body', 'score', 'stickied', 'distinguished') # comments and replies
+
+# comment requests in flight at once, every worker thread sends them with its own praw.Reddit (PRAW isn't thread-safe)
+# and its own prawcore rate limiter, all of them draw from the same per-account limit, so it's kept small
+max_concurrent_requests = 8
+max_request_retries = 4 # attempts after the first one for a failed comments request
+retry_backoff = 1.0 # seconds, doubled with every next attempt
+transient_errors = (RequestException, ServerError, TooManyRequests) # network errors, 5xx and 429 responses
+
+#processing settings
+posts_per_batch = 50 # posts processed at once and handed over to the insert thread
+insert_queue_size = 4 # processed batches waiting for insertion, bounds memory if inserts fall behind
+
+#sqlite settings for bulk loading
+sqlite_pragmas = ('locking_mode=EXCLUSIVE', # single writer for the lifetime of the connection (before WAL -> no shared memory index)
+                  'journal_mode=WAL', # no rollback journal writes, readers don't block the writer
+                  'synchronous=OFF', # no fsync at all - safe to lose on a crash, the database is rebuilt from Reddit on every run
+                  'temp_store=MEMORY',
+                  'cache_size=-200000', # negative value is in KiB -> ~200 MB page cache
+                  'mmap_size=268435456', # 256 MB
+                  'foreign_keys=OFF') # no per-row FK lookups during the load, parents are inserted before their children anyway
+sqlite_cached_statements = 256
+sqlite_max_variables = 999 # SQLITE_MAX_VARIABLE_NUMBER of sqlite builds older than 3.32.0, the lowest limit we can meet
+identifier_pattern = re.compile(r'[A-Za-z_][A-Za-z0-9_]*') # table names are interpolated into SQL, they can't be bound
+
+@lru_cache(maxsize=4)
+def fernet_key(password: str) -> Fernet:
+    '''
+    Creates Fernet object for the password, cached so the key is parsed only once per password.
+    '''
+    return Fernet(f'{password}=')
+
+@lru_cache(maxsize=4)
+def decrypt_credentials(private_path: str, password: str) -> Tuple[str, str, str]:
+    '''
+    Decrypts credentials needed to connect to Reddit API.
+    
+    Parameters:
+        private_path (str): Path to the .json file containing encrypted data needed to connect to API.
+        password (str): Password used to decrypt data.
+        
+    Returns:
+        Tuple[str, str, str]: client_id, client_secret and refresh_token.
+        
+    Notes:
+        - Results are cached per (private_path, password), so the file is read and decrypted only once per process.
+            Changes to the file made after the first call won't be picked up.
+        - Inner fields are expected as raw Fernet tokens (already URL-safe base64).
+            Files in the old format (base64 wrapped tokens) are still read, see migrate_credentials().
+    '''
+    key=fernet_key(password)
+    ec=json.loads(key.decrypt(read_file_bytes(private_path)).decode())
+    return tuple(key.decrypt(field_token(ec[field])).decode() for field in credential_fields)
+
+def read_file_bytes(path: str) -> bytes:
+    '''
+    Reads the whole file with a single os.read call.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+def field_token(value: str) -> bytes:
+    '''
+    Returns Fernet token of a credential field, unwrapping the old base64 format if needed.
+    '''
+    token = value.encode()
+    # Fernet tokens always start with version byte 0x80 -> 'gAAAAA' once base64 encoded
+    if token.startswith(b'gAAAAA'):
+        return token
+    return base64.b64decode(token)
+
+def migrate_credentials(private_path: str, password: str) -> None:
+    '''
+    Rewrites file with credentials so that inner fields are stored as raw Fernet tokens, without base64 wrapping.
+    
+    Parameters:
+        private_path (str): Path to the .json file containing encrypted data needed to connect to API.
+        password (str): Password used to decrypt data.
+        
+    Notes:
+        - New contents are written to a temporary file in the same directory, which then replaces the original
+            with os.replace(). If anything fails before that, the original file is left untouched.
+    '''
+    key=fernet_key(password)
+    ec=json.loads(key.decrypt(read_file_bytes(private_path)).decode())
+    ec.update({field: field_token(ec[field]).decode() for field in credential_fields})
+    encrypted = key.encrypt(json.dumps(ec).encode())
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(private_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(encrypted)
+            f.flush()
+            os.fsync(f.fileno()) # data is on disk before it replaces the only copy of the credentials
+        os.replace(temp_path, private_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    decrypt_credentials.cache_clear()
 
 def reddit_object(private_path: str, password: str) -> praw.reddit.Reddit:
     '''
@@ -28,13 +148,11 @@ def reddit_object(private_path: str, password: str) -> praw.reddit.Reddit:
     Parameters:
         private_path (str): Path to the .json file containing encrypted data needed to connect to API.
         password (str): Password used to decrypt data.
+        
+    Notes:
+        - Every call returns a new Reddit object, only decrypted credentials are cached (decrypt_credentials).
     '''
-    key=Fernet(f'{password}=')
-    with open(private_path, "rb") as f:
-        ec=json.loads(key.decrypt(f.read()).decode())
-    ci = key.decrypt(base64.b64decode(ec["client_id"])).decode()
-    cs = key.decrypt(base64.b64decode(ec["client_secret"])).decode()
-    rt = key.decrypt(base64.b64decode(ec["refresh_token"])).decode()
+    ci, cs, rt = decrypt_credentials(private_path=private_path, password=password)
 
     reddit = praw.Reddit(
         client_id = ci,
@@ -44,45 +162,92 @@ def reddit_object(private_path: str, password: str) -> praw.reddit.Reddit:
     )
     return reddit
 
-def start_connection(database_path: str = 'test_database.db') -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+def start_connection(database_path: str = 'test_database.db', in_memory: bool = False) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
     '''
     Creates a sqlite3 database and connects to it, creating connection and cursor objects.
     
     Parameters:
         database_path (str): Path to the database that will be created or overwritten.
+        in_memory (bool): If True, connection is made to an in-memory database instead of database_path.
+            Contents have to be written to disk afterwards with save_database().
         
     Returns:
         Tuple[sqlite3.Connection, sqlite3.Cursor]: Connection and Cursor objects needed for further interaction with new database.
         
     Notes:
-        - If a database provided with database_path already exists, this function will delete it and create new in its place.
-        - If there is already connection object (conn) in global scope, this function will attempt to close it before creating new connection object.
+        - If a database provided with database_path already exists, it is opened as is, without deleting the file.
+            Tables are replaced by create_tables() (or by save_database() when in_memory is used).
+        - Connection is owned by the caller, nothing is stored in module scope. Use database() to have it closed automatically.
+        - Connection is opened in autocommit mode (isolation_level=None) with PRAGMAs from global variable sqlite_pragmas,
+            callers are expected to wrap their writes in explicit transactions (transaction()).
+        - sqlite_pragmas turn off fsync (synchronous=OFF): the database can be corrupted by a power loss or OS crash mid-write,
+            which is acceptable because its contents are re-fetched from Reddit on every run.
     '''
-    global conn
-    if 'conn' in globals() and isinstance(conn, sqlite3.Connection):
-        try:
-            # Attempt to close the connection
-            conn.close()
-            print("Existing connection closed.")
-        except sqlite3.ProgrammingError:
-            # Catch the exception if the connection is already closed
-            pass
-        
-    if os.path.exists(database_path):
-        print(f"Database {database_path} already exists. Deleting it.")
-        os.remove(database_path)
+    if in_memory:
+        # database_path is only the target of save_database(), the file isn't opened here
+        print(f"Creating in-memory database, {database_path} will be overwritten by save_database().")
+    elif os.path.exists(database_path):
+        print(f"Database {database_path} already exists. Its tables will be replaced.")
     else:
         print(f"Database '{database_path}' does not exist. Creating it")
         
-    conn = sqlite3.connect(database_path)
+    # URI form makes the open mode explicit (read-write, create if missing)
+    # cache=shared is left out on purpose - it's discouraged with WAL and adds table-level locking
+    database_uri = 'file::memory:' if in_memory else f'file:{pathname2url(os.path.abspath(database_path))}?mode=rwc'
+    # isolation_level=None -> transactions are controlled explicitly with BEGIN/COMMIT
+    # check_same_thread=False -> fill_tables inserts from a worker thread (never concurrently with the caller)
+    conn = sqlite3.connect(database_uri, uri=True, isolation_level=None,
+                           cached_statements=sqlite_cached_statements, check_same_thread=False)
     cursor = conn.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(f'PRAGMA {pragma};')
     print('Connection established, new cursor object created.')
     return conn, cursor
 
+@contextmanager
+def database(database_path: str = 'test_database.db', in_memory: bool = False) -> Generator:
+    '''
+    Context manager around start_connection(), yields (conn, cursor) and closes the connection on exit.
+    '''
+    conn, cursor = start_connection(database_path=database_path, in_memory=in_memory)
+    try:
+        yield conn, cursor
+    finally:
+        conn.close()
 
-def prepare_database(cursor: sqlite3.Cursor=None, table_names: Tuple[str, str, str]=table_names) -> None:
+def save_database(conn: sqlite3.Connection, database_path: str) -> None:
     '''
-    Creates 3 tables and 3 additional indexes (beyond 3 default ones) in current connection.
+    Copies whole database from the connection (usually in-memory one) to a file with sqlite3 backup API.
+    
+    Parameters:
+        conn (sqlite3.Connection): SQLite database connection that holds the data.
+        database_path (str): Path to the database file that will be written.
+        
+    Notes:
+        - Function does not return anything, conn stays open.
+        - Filling a database in RAM and writing it once sequentially avoids page-cache/journal writes on every commit.
+            Whole database has to fit into memory.
+    '''
+    disk_conn = sqlite3.connect(database_path)
+    try:
+        disk_conn.execute('PRAGMA synchronous=OFF;') # same reasoning as in sqlite_pragmas
+        conn.backup(disk_conn, pages=-1)
+    finally:
+        disk_conn.close()
+    print(f'Database saved to {database_path}.')
+
+
+def validate_identifiers(names: Iterable[str]) -> None:
+    '''
+    Raises ValueError if any of names is not a plain SQL identifier (letters, digits, underscores).
+    '''
+    for name in names:
+        if not identifier_pattern.fullmatch(name):
+            raise ValueError(f"Invalid table name: {name!r}")
+
+def create_tables(cursor: sqlite3.Cursor=None, table_names: Tuple[str, str, str]=table_names) -> None:
+    '''
+    Creates 3 tables in current connection. Secondary indexes are created separately with create_indexes().
     
     Parameters:
         conn (sqlite3.Connection): SQLite database connection.
@@ -92,16 +257,21 @@ def prepare_database(cursor: sqlite3.Cursor=None, table_names: Tuple[str, str, s
     Notes:
         - Function modifies database in-place, does not return anything.
         - Because of hard-coded column names, expected order of tables is: Posts, Comments, Replies.
-        - Function will atempt to use global conn and cursor objects if none were provided within parameters.
-        - If tables with table_names (at least one) already exist in this database, function will wipeout all tables before proceeding.
+        - cursor has to be provided, there are no module-level connection objects to fall back to.
+        - If tables with table_names already exist in this database, function will drop them (with their indexes) before proceeding.
+        - Indexes are left out on purpose: bulk insert into tables without secondary indexes is cheaper,
+            and building them afterwards takes one sort per index instead of a B-tree update per inserted row.
+        - Created columns hold integer unix epoch, every table gets a view {table}_v with an extra readable Created_iso column.
+        - Table names are validated with validate_identifiers() before being put into SQL.
     '''   
-    cursor.execute(f'''SELECT count(name) FROM sqlite_master WHERE type='table' AND name IN {table_names};''')
-    if cursor.fetchone()[0] > 0: # also assuming there already are indexes
-        for table in table_names:
-            cursor.execute(f'''DELETE FROM {table};''')
-    else:
-        cursor.execute("BEGIN TRANSACTION;")
-        try:
+    validate_identifiers(table_names)
+    try:
+        with transaction(cursor=cursor):
+            # dropping (children first) instead of deleting rows also removes old indexes, so the CREATE path always runs
+            for table in reversed(table_names):
+                cursor.execute(f'DROP VIEW IF EXISTS {table}_v;')
+                cursor.execute(f'DROP TABLE IF EXISTS {table};')
+
             cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS {table_names[0]} (
                     Id TEXT PRIMARY KEY,
@@ -150,32 +320,59 @@ def prepare_database(cursor: sqlite3.Cursor=None, table_names: Tuple[str, str, s
                     FOREIGN KEY (Parent_id) REFERENCES Comments(Comment_id) ON DELETE CASCADE
                 );
             ''')
-            
-            cursor.execute('CREATE INDEX idx_Comments_Submission_id ON Comments(Submission_id);')
-            cursor.execute('CREATE INDEX idx_Replies_Submission_id ON Replies(Submission_id);')
-            cursor.execute('CREATE INDEX idx_Replies_Parent_id ON Replies(Parent_id);')
-            cursor.execute('COMMIT;')
-            
-        except sqlite3.Error as e:
-            print("SQLite error:", e.__class__.__name__, "\n", e)
-            cursor.execute("ROLLBACK;")
-        except Exception as e:
-            print("Error:", e.__class__.__name__, "\n", e)
-            cursor.execute("ROLLBACK;")
+        
+            # conversion is done on read, views are only stored SQL so they cost nothing during the load
+            for table in table_names:
+                cursor.execute(f'''
+                    CREATE VIEW IF NOT EXISTS {table}_v AS
+                    SELECT *, datetime(Created, 'unixepoch') AS Created_iso FROM {table};
+                ''')
+        
+    except sqlite3.Error as e:
+        print("SQLite error:", e.__class__.__name__, "\n", e)
+    except Exception as e:
+        print("Error:", e.__class__.__name__, "\n", e)
+
+def create_indexes(cursor: sqlite3.Cursor, table_names: Tuple[str, str, str]=table_names) -> None:
+    '''
+    Creates 3 additional indexes (beyond 3 default ones) on foreign key columns of Comments and Replies:
+    Comments(Submission_id), Replies(Submission_id, Parent_id) and Replies(Parent_id).
+    
+    Parameters:
+        cursor (sqlite3.Cursor): SQLite database cursor.
+        table_names (Tuple[str, str, str]): Tuple of 3 table names, assumed order: Posts, Comments, Replies.
+        
+    Notes:
+        - Function modifies database in-place, does not return anything.
+        - Meant to be called after the bulk load, indexes that already exist are skipped.
+            Until then lookups by Submission_id / Parent_id are full table scans, by design.
+        - create_tables() drops the tables together with their indexes, so every fresh load starts without them.
+        - Tables are analyzed after the indexes are built, so the query planner can choose between them.
+    '''
+    validate_identifiers(table_names)
+    try:
+        with transaction(cursor=cursor):
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_names[1]}_Submission_id ON {table_names[1]}(Submission_id);')
+            # composite index also serves lookups by Submission_id alone (leftmost column), so no separate one is needed
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_names[2]}_Submission_id_Parent_id ON {table_names[2]}(Submission_id, Parent_id);')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_names[2]}_Parent_id ON {table_names[2]}(Parent_id);')
+            # statistics for the query planner (sqlite_stat1), gathered once over the loaded data
+            for table in table_names:
+                cursor.execute(f'ANALYZE {table};')
+        
+    except sqlite3.Error as e:
+        print("SQLite error:", e.__class__.__name__, "\n", e)
+    except Exception as e:
+        print("Error:", e.__class__.__name__, "\n", e)
 
 def batch_generator(iterable: Iterable, batch_size: int) -> Generator:
     '''
     Generator to yield batches of items from an iterable.
     '''
-    batch = []
-    for item in iterable:
-        batch.append(item)
-        if len(batch) == batch_size:
-            yield batch
-            batch = []
-    if batch:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
         yield batch
-        
+
 def praw_get_data(query: str,
                   posts_limit: int = 100,
                   reddit: praw.reddit.Reddit = None) -> List:
@@ -184,102 +381,312 @@ def praw_get_data(query: str,
     '''
     if posts_limit > max_posts_per_request:
         div, mod = divmod(posts_limit, max_posts_per_request)
-        last_post_id = None
+        last_post_fullname = None
         after_param = None
-        result_collection = chain()
+        result_collection = []
         for i in range(div+1):
             if i == div and mod == 0:
                 break
-            if last_post_id:
-                after_param = last_post_id
+            if last_post_fullname:
+                after_param = last_post_fullname
 
+            page_limit = max_posts_per_request if i != div else mod
             search_results = list(reddit.subreddit('all').search(query,
-                                                                 limit=max_posts_per_request if i != div else mod,
+                                                                 limit=page_limit,
                                                                  params={'after': after_param}))
             
-            result_collection = chain(result_collection, search_results)
-            last_post_id = search_results[-1].id
+            if not search_results: # no more results for the query
+                break
+            result_collection.extend(search_results)
+            if len(search_results) < page_limit: # short page -> results exhausted, next request would come back empty
+                break
+            # 'after' expects a fullname ('t3_' + id), with a bare id Reddit ignores it and returns the first page again
+            last_post_fullname = search_results[-1].fullname
 
     else:
         result_collection = reddit.subreddit('all').search(query, limit=posts_limit)
 
-    return list(result_collection)
-        
+    # pages can overlap when results shift between requests, duplicates are dropped by id
+    # so their comments aren't fetched and processed twice (dict keeps the search order)
+    return list({post.id: post for post in result_collection}.values())
+
+def retry_after_seconds(error: TooManyRequests) -> float:
+    '''
+    Reads how long to wait after a 429 response from its Retry-After or X-Ratelimit-Reset header (both in seconds).
+
+    Returns:
+        float: Seconds to wait, 0.0 if neither header is present or parseable.
+    '''
+    headers = error.response.headers
+    for header in ('retry-after', 'x-ratelimit-reset'):
+        try:
+            return float(headers[header])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return 0.0
+
+def fetch_comments(post: praw.models.Submission,
+                   retries: int = max_request_retries,
+                   backoff: float = retry_backoff) -> praw.models.comment_forest.CommentForest:
+    '''
+    Loads comment forest of a single post, retrying transient errors.
+
+    Notes:
+        - Requests are paced by prawcore's rate limiter of the Reddit object the post belongs to.
+        - Network errors and 5xx responses are retried with exponential backoff.
+        - After a 429 response the retry waits at least for the reset time the response reports.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return post.comments
+        except TooManyRequests as e:
+            if attempt == retries:
+                raise
+            time.sleep(max(backoff * 2 ** attempt, retry_after_seconds(e)))
+        except transient_errors:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def praw_fetch_comments(posts: List[praw.models.Submission],
+                        reddit_factory: Optional[Callable[[], praw.reddit.Reddit]] = None,
+                        max_workers: int = max_concurrent_requests) -> List[praw.models.Submission]:
+    '''
+    Loads comment forests of all posts, with concurrent requests to Reddit API if reddit_factory is given.
+
+    Parameters:
+        posts (List[praw.models.Submission]): Posts returned by search, comments are not loaded yet.
+        reddit_factory (Callable[[], praw.reddit.Reddit]): Creates a new Reddit object, called once per worker thread,
+            e.g. functools.partial(reddit_object, private_path=..., password=...). If None, comments are loaded
+            one post after another with the Reddit object the posts were retrieved with.
+        max_workers (int): Maximum number of requests in flight at the same time.
+
+    Returns:
+        List[praw.models.Submission]: Posts whose comments were loaded, in the original order.
+            With reddit_factory these are new Submission objects of the worker threads' Reddit objects,
+            loaded together with their comments in the same request.
+
+    Notes:
+        - A post whose request still fails after all retries (or fails with any other API error) is reported and left out,
+            so one post can't abort the whole run. It's dropped instead of being processed, reading its comments later
+            would just send the failing request again.
+        - Every post needs its own request for comments, these requests are blocking network I/O,
+            so they are overlapped in a small thread pool instead of being sent one after another.
+        - PRAW objects aren't thread-safe, so every worker thread makes requests only through its own Reddit object
+            and is paced by its own prawcore rate limiter. Limiters read the remaining requests of the shared
+            per-account limit from response headers, requests failing with 429 are retried by fetch_comments().
+    '''
+    def comments_loaded(post: praw.models.Submission) -> Optional[praw.models.Submission]:
+        try:
+            fetch_comments(post=post)
+            return post
+        except PrawcoreException as e:
+            print(f"Comments of post {post.id} couldn't be loaded, skipping the post:", e.__class__.__name__, "\n", e)
+            return None
+
+    if reddit_factory is None:
+        loaded_posts = map(comments_loaded, posts)
+        return [post for post in loaded_posts if post is not None]
+
+    worker_state = local() # Reddit object of the current worker thread
+
+    def worker_comments_loaded(post: praw.models.Submission) -> Optional[praw.models.Submission]:
+        reddit = getattr(worker_state, 'reddit', None)
+        if reddit is None:
+            reddit = worker_state.reddit = reddit_factory()
+        # lazy object, its first attribute access fetches the post together with its comments
+        return comments_loaded(reddit.submission(id=post.id))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [post for post in executor.map(worker_comments_loaded, posts) if post is not None]
+
 def process_posts(posts_batch: List[praw.models.Submission],
                   comments_limit: int,
-                  replies_limit: int) -> List[List[List[Any]]]:
+                  replies_limit: int) -> Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]], List[Tuple[Any, ...]]]:
     '''
     Processes a batch of Reddit posts extracting crucial data.
     Collects information from posts, comments to these posts, and replies to these comments (only 1st level of depth).
+    Every row is a tuple (fixed size, no over-allocation like with lists) ready to be bound by executemany.
+    Creation times are kept as integer unix epoch, convert on read with e.g. datetime(Created, 'unixepoch').
     '''
     comment_data = []
     reply_data = []
     post_data = []
+    # bound methods and getters looked up once instead of on every row of the hot loop
+    add_comment, add_reply, add_post = comment_data.append, reply_data.append, post_data.append
+    get_post_fields, get_comment_fields = post_fields_getter, comment_fields_getter
 
     for post in posts_batch:
-        post_data.append([
-            post.id,
-            post.title,
-            post.author.name if post.author else None,
-            post.author_flair_text,
-            post.created_utc,
-            int(post.is_self),
-            post.selftext,
-            post.num_comments,
-            post.score,
-            post.upvote_ratio,
-            post.stickied,
-            post.distinguished,
-            post.url
-        ])
+        (post_id, ptitle, pauth, pflair, pcrt, pself, ptext,
+         pnum, pscore, pratio, pstic, pdist, purl) = get_post_fields(post)
+        add_post((
+            post_id,
+            ptitle,
+            pauth.name if pauth is not None else None, # deleted accounts have author None
+            pflair,
+            int(pcrt),
+            int(pself),
+            ptext,
+            pnum,
+            pscore,
+            pratio,
+            pstic,
+            pdist,
+            purl
+        ))
         
-        batch_comments = []
-        for comment in post.comments[:comments_limit]:
-            if isinstance(comment, praw.models.MoreComments):
-                break
+        # limit=0 only drops MoreComments placeholders (no requests), list() flattens the forest breadth-first
+        post.comments.replace_more(limit=0)
+        top_comments = []
+        top_ids = set() # ids of all top-level comments, also the ones over comments_limit
+        num_replies = {} # kept top-level comment id -> number of replies kept
+        for comment in post.comments.list():
+            parent_id = comment.parent_id
+            if parent_id.startswith('t3_'): # top-level comment, parent is the post itself
+                top_ids.add(comment.id)
+                if len(top_comments) < comments_limit:
+                    top_comments.append(comment)
+                    num_replies[comment.id] = 0
+                continue
             
-            batch_replies = []
-            num_replies = 0 
-            for reply in comment.replies[:replies_limit]:
-                if isinstance(reply, praw.models.MoreComments):
-                    break
-                
-                batch_replies.append([
-                    reply.id,
-                    reply.author.name if reply.author else None,
-                    reply.created_utc,
-                    post.id,
-                    comment.id,
-                    reply.body,
-                    reply.score,
-                    reply.stickied,
-                    reply.distinguished
-                ])
-                num_replies += 1
-            reply_data.extend(batch_replies)
+            comment_id = parent_id[3:] # strip 't1_'
+            if comment_id not in top_ids:
+                # list() is breadth-first, first reply to a reply means all remaining items are deeper
+                break
+            replies_count = num_replies.get(comment_id)
+            if replies_count is None or replies_count >= replies_limit: # parent dropped or replies over the limit
+                continue
+            num_replies[comment_id] = replies_count + 1
             
-            batch_comments.append([
-                comment.id,
-                comment.author.name if comment.author else None,
-                comment.created_utc,
-                post.id,
-                comment.body,
-                num_replies,
-                comment.score,
-                comment.stickied,
-                comment.distinguished
-            ])
-        comment_data.extend(batch_comments)   
-
-    return [post_data, comment_data, reply_data]
+            rid, rauth, rcrt, rbody, rscore, rstic, rdist = get_comment_fields(comment)
+            add_reply((
+                rid,
+                rauth.name if rauth is not None else None,
+                int(rcrt),
+                post_id,
+                comment_id,
+                rbody,
+                rscore,
+                rstic,
+                rdist
+            ))
+        
+        for comment in top_comments:
+            comment_id, cauth, ccrt, cbody, cscore, cstic, cdist = get_comment_fields(comment)
+            add_comment((
+                comment_id,
+                cauth.name if cauth is not None else None,
+                int(ccrt),
+                post_id,
+                cbody,
+                num_replies[comment_id],
+                cscore,
+                cstic,
+                cdist
+            ))
+
+    return post_data, comment_data, reply_data
+    
+@lru_cache(maxsize=None)
+def insert_queries(table_name: str, table_index: int, max_variables: int = sqlite_max_variables) -> Tuple[int, str, str]:
+    '''
+    Builds insert statements for a table, cached per table name so SQL strings are built once per program run
+    and identical strings let sqlite3 reuse prepared statements.
+    
+    Parameters:
+        table_name (str): Name of the table, validated by the caller (validate_identifiers()).
+        table_index (int): Position of the table in the order Posts, Comments, Replies, selects its columns
+            from global variables table_columns_global and upsert_columns_global.
+        max_variables (int): Maximum number of bound parameters in one statement.
+    
+    Returns:
+        Tuple[int, str, str]: Number of rows per multi-row statement, the multi-row statement and the single-row one.
+    '''
+    columns = table_columns_global[table_index]
+    # only overwrite when the score didn't drop -> rows from an older snapshot don't cause a write
+    upsert_clause = (f' ON CONFLICT(Id) DO UPDATE SET {", ".join(f"{column}=excluded.{column}" for column in upsert_columns_global[table_index])}'
+                     f' WHERE excluded.Score >= {table_name}.Score')
+    rows_per_statement = max(1, max_variables // len(columns))
+    row_placeholders = f'({", ".join(["?"] * len(columns))})'
+    insert_start = f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES '
+    multi_row_query = insert_start + ", ".join([row_placeholders] * rows_per_statement) + upsert_clause
+    single_row_query = insert_start + row_placeholders + upsert_clause
+    return rows_per_statement, multi_row_query, single_row_query
+
+def batched_insert(cursor: sqlite3.Cursor,
+                   table_name: str,
+                   table_index: int,
+                   rows: Iterable[Tuple[Any, ...]],
+                   max_variables: int = sqlite_max_variables) -> None:
+    '''
+    Inserts rows into a table with multi-row INSERT ... VALUES (...), (...), ... ON CONFLICT statements.
+    
+    Parameters:
+        cursor (sqlite3.Cursor): SQLite database cursor.
+        table_name (str): Name of a table.
+        table_index (int): Position of the table in the order Posts, Comments, Replies (see insert_queries()).
+        rows (Iterable[Tuple[Any, ...]]): Rows with values in the same order as table columns, can be a generator.
+        max_variables (int): Maximum number of bound parameters in one statement.
+        
+    Notes:
+        - Function modifies table in-place, does not return anything.
+        - Every statement carries as many full rows as fit into max_variables, so SQLite steps through
+            one statement per chunk instead of one per row. Chunks share the same SQL string and are run with
+            a single executemany, rows that don't fill the last chunk are inserted with the single-row query.
+        - Rows are consumed lazily chunk by chunk, so at most one chunk is held in memory on top of what the caller holds.
+    '''
+    rows_per_statement, multi_row_query, single_row_query = insert_queries(table_name, table_index, max_variables)
+    
+    rows_iter = iter(rows)
+    remainder = []
+    def full_chunks():
+        while True:
+            chunk = list(islice(rows_iter, rows_per_statement))
+            if len(chunk) < rows_per_statement:
+                remainder.extend(chunk)
+                return
+            yield [value for row in chunk for value in row]
     
+    cursor.executemany(multi_row_query, full_chunks())
+    cursor.executemany(single_row_query, remainder)
+    
+def insert_worker(cursor: sqlite3.Cursor,
+                  rows_queue: Queue,
+                  table_names: Tuple[str, str, str],
+                  errors: List[Exception]) -> None:
+    '''
+    Inserts batches of rows taken from a queue until None is received. Meant to be a target of a thread.
+    
+    Parameters:
+        cursor (sqlite3.Cursor): SQLite database cursor, not used by any other thread meanwhile.
+        rows_queue (Queue): Queue with outputs of process_posts(), None marks the end of data.
+        table_names (Tuple[str, str, str]): Table names, assumed order: Posts, Comments, Replies.
+        errors (List[Exception]): Exceptions raised while inserting are appended here for the calling thread.
+        
+    Notes:
+        - Does not commit, transaction is handled by the caller.
+        - After the first error remaining batches are only drained, so the producer never blocks on a full queue.
+    '''
+    while True:
+        batch = rows_queue.get()
+        if batch is None:
+            return
+        if errors:
+            continue
+        try:
+            for table_index, (table, rows) in enumerate(zip(table_names, batch)):
+                batched_insert(cursor=cursor, table_name=table, table_index=table_index, rows=rows)
+        except Exception as e:
+            errors.append(e)
+
 def fill_tables(cursor: sqlite3.Cursor,
                 reddit: praw.reddit.Reddit,
                 query: str,
                 posts_limit: int,
                 comments_limit: int,
                 replies_limit: int,
-                table_names: Tuple[str, str, str]) -> None:
+                table_names: Tuple[str, str, str],
+                reddit_factory: Optional[Callable[[], praw.reddit.Reddit]] = None) -> None:
     '''
     Gathers data from Reddit API by making requests and inserts it into SQL tables.
     
@@ -291,49 +698,71 @@ def fill_tables(cursor: sqlite3.Cursor,
         posts_limit (int): Limit of posts retrieved. Won't exceed global variable praw_posts_limit.
         comments_limit (int): Limit of comments retrieved from posts. Maximum 100.
         replies_limit (int): Limit of replies retrieved from comments. Maximum 100.
-        table_names (Tuple[str, str, str, str]): Table names, assumed order: Posts, Subreddits, Comments, Replies.
+        table_names (Tuple[str, str, str]): Table names, assumed order: Posts, Comments, Replies.
+            Validated with validate_identifiers(), insert queries are built once per name (insert_queries()).
+        reddit_factory (Callable[[], praw.reddit.Reddit]): Creates Reddit objects for worker threads loading comments
+            concurrently (see praw_fetch_comments()). If None, comments are loaded serially with reddit.
     
     Notes:
-        - Uses INSERT OR IGNORE to fill data because of existance of different snapshots of the same object.
-            Primary key constraint helps here to avoid duplicates.
-        - Function will utilitize maximum number of available cpu cores.
+        - Uses UPSERT (ON CONFLICT(Id) DO UPDATE) because of existance of different snapshots of the same object.
+            Primary key constraint avoids duplicates, counters and scores of an existing row are refreshed
+            only when the new snapshot's score is not lower (upsert_columns_global).
+        - Requests for comments are made concurrently when reddit_factory is given (praw_fetch_comments), processing of retrieved data runs in a single process.
+        - Posts are processed in batches of posts_per_batch and inserted by a separate thread (insert_worker),
+            SQLite releases the GIL while stepping statements, so building rows of the next batch overlaps with inserting the previous one.
+        - Secondary indexes are created with create_indexes() only after the data is committed,
+            nothing is indexed when the load is rolled back.
     '''
-    post_columns_local = post_columns_global
-    comment_columns_local, reply_columns_local = comment_columns_global, reply_columns_global
+    validate_identifiers(table_names)
     posts_limit = min(praw_posts_limit, posts_limit)
     result_collection = praw_get_data(query=query,
                                       posts_limit=posts_limit,
                                       reddit=reddit)
-    
-    batch_size = (posts_limit // (2 * os.cpu_count())) + 1
-    results = Parallel(n_jobs=-1)(delayed(process_posts)(posts_batch, comments_limit, replies_limit) for posts_batch in batch_generator(result_collection, batch_size))
-    aggregated_posts = []
-    aggregated_comments = []
-    aggregated_replies = []
-
-    for post_list, comment_list, reply_list in results:
-        aggregated_posts.extend(post_list)
-        aggregated_comments.extend(comment_list)
-        aggregated_replies.extend(reply_list)
-    
-    insert_posts_query = f'INSERT OR IGNORE INTO {table_names[0]} ({", ".join(post_columns_local)}) VALUES ({", ".join(["?"] * len(post_columns_local))})'
-    insert_comments_query = f'INSERT OR IGNORE INTO {table_names[1]} ({", ".join(comment_columns_local)}) VALUES ({", ".join(["?"] * len(comment_columns_local))})'
-    insert_replies_query = f'INSERT OR IGNORE INTO {table_names[2]} ({", ".join(reply_columns_local)}) VALUES ({", ".join(["?"] * len(reply_columns_local))})'
-    
-    cursor.execute("BEGIN TRANSACTION;")
+    result_collection = praw_fetch_comments(posts=result_collection, reddit_factory=reddit_factory)
+
+    # one transaction for all tables -> single commit instead of one per statement
+    # IMMEDIATE takes the write lock up front instead of upgrading from a read lock on the first insert
+    rows_queue = Queue(maxsize=insert_queue_size)
+    insert_errors = []
     try:
-        cursor.executemany(insert_posts_query, aggregated_posts)
-        cursor.executemany(insert_comments_query, aggregated_comments)
-        cursor.executemany(insert_replies_query, aggregated_replies)
-        cursor.execute("COMMIT;")
+        with transaction(cursor=cursor, begin='BEGIN IMMEDIATE'):
+            writer = Thread(target=insert_worker, args=(cursor, rows_queue, table_names, insert_errors))
+            writer.start()
+            try:
+                # comments are already loaded, so processing is plain attribute reads - no need for worker processes
+                # duplicates are merged by the primary key (UPSERT keeps one row per Id)
+                for posts_batch in batch_generator(result_collection, posts_per_batch):
+                    rows_queue.put(process_posts(posts_batch=posts_batch,
+                                                 comments_limit=comments_limit,
+                                                 replies_limit=replies_limit))
+            finally:
+                rows_queue.put(None)
+                writer.join()
+            if insert_errors:
+                raise insert_errors[0]
         
     except sqlite3.Error as e:
         print("SQLite error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")
     except Exception as e:
         print("Error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")
+    else:
+        # indexes are built once over loaded data instead of being maintained row by row
+        create_indexes(cursor=cursor, table_names=table_names)
         
+class FileNameTable(dict):
+    '''
+    Translation table for str.translate keeping word characters, dots and hyphens (same as regex [\\w.-]).
+    Entries are computed on first lookup of a character and cached, instead of building a table for every code point.
+    '''
+    def __missing__(self, code: int):
+        char = chr(code)
+        # str.isalnum() + '_' is what re treats as \w for str patterns
+        value = code if char.isalnum() or char in '_.-' else None
+        self[code] = value
+        return value
+
+file_name_table = FileNameTable()
+
 def sanitize_file_name(filename: str, character_limit: int = 50) -> str:
     '''
     Cleans file name in order to assure file creation.
@@ -344,7 +773,7 @@ def sanitize_file_name(filename: str, character_limit: int = 50) -> str:
     '''
     if not filename:
         raise ValueError("File name cannot be empty")
-    filename = re.sub(r'[^\w\.-]', '', filename)
+    filename = filename.translate(file_name_table)
     filename = filename[:character_limit]
     return filename
 
@@ -362,20 +791,22 @@ def main(): # for testing
     query = input("Provide query for search: ")
     
     reddit = reddit_object(private_path=private_path, password=password)
-    conn, cursor = start_connection(database_path=os.path.join(data_dir, database_name))
-    prepare_database(cursor=cursor)
-    print(f'Inserting values into database {database_name}...')
-    start_time = time.time()
-    fill_tables(cursor=cursor,
-                reddit=reddit,
-                query=query,
-                posts_limit=300,
-                comments_limit=50,
-                replies_limit=20,
-                table_names=table_names)
-    end_time = time.time()
-    print(f'Operation complete, database filled.\nTime taken: {end_time - start_time:.4f} seconds.')
-    conn.close()
+    database_path = os.path.join(data_dir, database_name)
+    with database(database_path=database_path, in_memory=True) as (conn, cursor):
+        create_tables(cursor=cursor)
+        print(f'Inserting values into database {database_name}...')
+        start_time = time.time()
+        fill_tables(cursor=cursor,
+                    reddit=reddit,
+                    query=query,
+                    posts_limit=300,
+                    comments_limit=50,
+                    replies_limit=20,
+                    table_names=table_names,
+                    reddit_factory=partial(reddit_object, private_path=private_path, password=password))
+        end_time = time.time()
+        print(f'Operation complete, database filled.\nTime taken: {end_time - start_time:.4f} seconds.')
+        save_database(conn=conn, database_path=database_path)
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,28 @@
+import sqlite3
+from contextlib import contextmanager
+from typing import Generator
+
+@contextmanager
+def transaction(cursor: sqlite3.Cursor, begin: str = 'BEGIN') -> Generator[None, None, None]:
+    '''
+    Wraps statements executed inside the with block in one explicit transaction.
+
+    Parameters:
+        cursor (sqlite3.Cursor): Cursor of a connection with isolation_level=None (no implicit transactions).
+        begin (str): Statement starting the transaction, e.g. 'BEGIN IMMEDIATE' to take the write lock up front.
+
+    Notes:
+        - Commits when the block finishes, rolls back on any exception and re-raises it.
+            A failed COMMIT (e.g. SQLITE_BUSY, disk full) is rolled back too, so the connection is never left
+            inside an open transaction and the next BEGIN works.
+        - ROLLBACK is issued only if the transaction is still open, SQLite rolls back by itself after some errors.
+        - Shared by Database_start.py and Text_preprocess.py, kept free of their heavy imports (praw, spaCy).
+    '''
+    cursor.execute(f'{begin};')
+    try:
+        yield
+        cursor.execute('COMMIT;')
+    except BaseException:
+        if cursor.connection.in_transaction:
+            cursor.execute('ROLLBACK;')
+        raise
@@ -3,9 +3,19 @@ import spacy
 from spacy.lang.en.stop_words import STOP_WORDS
 from string import punctuation
 import os
+import sys
 import json
+try:
+    import orjson # C implementation, several times faster on lists of short strings
+except ImportError:
+    orjson = None
 import re
-from typing import Dict, List, Tuple
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Generator, Iterable, List, Set, Tuple, Union
+from Database_transaction import transaction
 
 # config
 # if table_names will be parameterized, ensure its sanitazed to prevent dangerous injection to sql
@@ -13,8 +23,104 @@ table_names = ('Posts', 'Comments', 'Replies')
 text_content_column_name = 'Text_content'
 table_columns_dict = {table:text_content_column_name for table in table_names}
 new_columns_global = ['Raw_tokens', 'Lemma_lower_tokens', 'Lemma_lower_stop_tokens']
-nlp_model = spacy.load('en_core_web_md')
+# 0/1 flag added by preprocess_tables_text(), re-runs clean only rows inserted since the last run
+cleaned_column_name = 'Cleaned'
+# applied in main() right after connecting, the pass is a few large UPDATEs over whole tables
+# all but journal_mode last only for the connection, closing it restores the defaults
+sqlite_pragmas = ('locking_mode=EXCLUSIVE', # single writer, locks are kept instead of taken per transaction (before WAL -> no shared memory index)
+                  'journal_mode=WAL',
+                  'synchronous=NORMAL', # fsync only at WAL checkpoints, not on every commit
+                  'temp_store=MEMORY',
+                  'cache_size=-524288', # negative value is in KiB -> ~512 MB page cache
+                  'mmap_size=268435456') # 256 MB
+spacy_model_name = 'en_core_web_md' # loaded on first use by load_nlp_model(), not at import
+# only token.text and token.lemma_ are used, pipes kept in en_core_web_md:
+#   tok2vec - shared embeddings the tagger listens to (tagger breaks without it)
+#   tagger - fine-grained token.tag_
+#   attribute_ruler - maps tag_ to token.pos_, which the rule-based lemmatizer looks up
+#   lemmatizer - token.lemma_
+# dependency parser (token.dep_, sentences) and NER (doc.ents) aren't needed
+spacy_disabled_pipes = ('parser', 'ner')
+# True -> blank English pipeline with lookup lemmatizer instead of spacy_model_name, much faster on short texts
+# and without the ~120 MB of vectors, but lemmas come from a table (no POS) and differ slightly from the default ones,
+# needs spacy-lookups-data package
+spacy_lookup_lemmatizer = False
+# fallback for json_dumps() without orjson, produces the same compact output (no spaces, non-ASCII not escaped)
+json_encoder_global = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+# None -> tokens stored as JSON text, 1-9 -> JSON compressed with zlib at that level and stored as BLOB,
+# rows get several times smaller (less to write and cache) but every reader has to use tokens_load()
+tokens_compression_level = None
 STOP_WORDS_SET = set(STOP_WORDS) # for faster retrieval
+# 'token in punctuation' is a substring test ('(', '()' and '' are filtered, '...' is not), the set of all substrings
+# keeps exactly that behavior with a hash lookup instead of a scan over the string
+punctuation_substrings = frozenset(punctuation[start:end] for start in range(len(punctuation) + 1)
+                                   for end in range(start, len(punctuation) + 1))
+empty_texts = frozenset(('[deleted]', '[removed]', '')) # text contents treated as missing (NULL)
+tokenize_batch_size = 256 # texts passed through spaCy pipeline at once (nlp.pipe)
+# spaCy worker processes, every one of them loads its own copy of the model (several hundred MB and a few seconds each),
+# one core is left for the main process and the count is capped so RSS stays bounded on many-core machines
+tokenize_n_process = max(1, min(4, (os.cpu_count() or 1) - 1))
+# tables with fewer texts than this are tokenized in the main process, forking and loading models would take longer
+tokenize_multiprocess_min_rows = 20000
+# rows updated with tokens per transaction, keeps the journal small and commits progress as tokenizing goes
+tokens_per_commit = 2000
+# serialized tokens of short texts are kept while tokenizing, repeated texts ("thanks", "lol", bot messages)
+# skip spaCy, least recently used entries are dropped first when the cache is full (0 -> no caching)
+tokens_cache_size = 50000
+tokens_cache_max_text_length = 200 # longer texts are rarely repeated, their tokens aren't cached
+profile_top_functions = 30 # rows of cProfile stats printed when run with --profile
+# (pattern, replacement, required substring) applied in this order by clean_text(), compiled once at import
+# a pass is skipped when the text doesn't contain its required substring (None = always applied), the substring
+# check is a single fast scan, while every applied pattern walks the whole text
+cleaning_patterns_global = tuple((re.compile(pattern), replacement, required) for pattern, replacement, required in (
+    (r"http\S+|www\S+|\S*\.com\S*|<.*?>|(?![\u2019\n])[^ -~]|[;:](?:-)?(?:([BCDOPVXbcdopvx30\(\)\[\]/\\\\*><])\\1*)|x200B.", "", None),
+    (r"’", "'", "’"),
+    (r"(?<![\.\s])\n+", ". ", "\n"),
+    (r"\n+", " ", "\n"),
+    (r"[^0-9A-Za-z()\\'?!:,. +\\-\\x22]", "", None),
+    (r"([.!?,-])\\1+", r"\\1", "\\1"), # \\1 in the pattern is a literal backslash followed by 1
+    (r"\s{2,}", " ", "  "), # only spaces are left as whitespace at this point
+))
+# SQL condition true for every text clean_text() can change, GLOB is case-sensitive like the patterns
+# text with only letters, digits and spaces can be changed only by http/www/x200B branches, repeated spaces,
+# spaces stripped from the ends or by being empty, NULL -> condition is NULL and the value stays NULL
+clean_text_needed_sql = ("{column} GLOB '*[^A-Za-z0-9 ]*' OR {column} = '' OR {column} GLOB '*  *'"
+                         " OR {column} GLOB ' *' OR {column} GLOB '* '"
+                         " OR {column} GLOB '*http*' OR {column} GLOB '*www*' OR {column} GLOB '*x200B*'")
+# first pattern without its \S*\.com\S* branch, which never matches a text without '.com' in it but still makes
+# the regex engine try \S* at every position - texts without that literal are cleaned with this variant instead
+cleaning_patterns_no_com_global = ((re.compile(r"http\S+|www\S+|<.*?>|(?![\u2019\n])[^ -~]|[;:](?:-)?(?:([BCDOPVXbcdopvx30\(\)\[\]/\\\\*><])\\1*)|x200B."), "", None),
+                                   ) + cleaning_patterns_global[1:]
+
+@lru_cache(maxsize=1)
+def load_nlp_model() -> spacy.lang.en.English:
+    '''
+    Loads SpaCy model spacy_model_name without spacy_disabled_pipes, cached so it's loaded only once per process.
+    With spacy_lookup_lemmatizer set, a blank English pipeline with lookup lemmatizer is created instead.
+
+    Notes:
+        - Importing this module for text cleaning alone doesn't load the model (~1.5 s and ~200 MB).
+    '''
+    if spacy_lookup_lemmatizer:
+        nlp_model = spacy.blank('en')
+        nlp_model.add_pipe('lemmatizer', config={'mode': 'lookup'})
+        nlp_model.initialize() # loads lookup tables from spacy-lookups-data
+        return nlp_model
+    return spacy.load(spacy_model_name, disable=list(spacy_disabled_pipes))
+
+def table_columns(cursor: sqlite3.Cursor, table_name: str) -> Set[str]:
+    '''
+    Returns names of all columns in the table, read with a single PRAGMA table_info query.
+    '''
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return {col[1] for col in cursor.fetchall()}
+
+def column_not_null(cursor: sqlite3.Cursor, table_name: str, column_name: str) -> bool:
+    '''
+    Checks if a column is declared NOT NULL, read from PRAGMA table_info.
+    '''
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return any(col[1] == column_name and col[3] for col in cursor.fetchall())
 
 def check_column_exist(cursor: sqlite3.Cursor, check_dict: Dict[str, str]) -> bool:
     '''
@@ -34,141 +140,168 @@ def check_column_exist(cursor: sqlite3.Cursor, check_dict: Dict[str, str]) -> bo
             'table2': 'column2',
         })
     '''
-    for table_name, column_name in check_dict.items():
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        if not any(column_name == col[1] for col in cursor.fetchall()):
-            return False
-    return True
+    return all(column_name in table_columns(cursor=cursor, table_name=table_name)
+               for table_name, column_name in check_dict.items())
 
-def regex_replace(text: str, pattern: str, replacement: str) -> str:
+def clean_text(text: str) -> str:
     '''
-    Replaces ALL text matching patterns with replacement using regular expression.
+    Applies all cleaning patterns from global variable cleaning_patterns_global to text in a single call.
     
     Parameters:
-        text (str): Text content, target replacement.
-        pattern (str): RegEx pattern to match in 'text'.
-        replacement (str): String replacing all matched characters in 'text'.
+        text (str): Text content to clean.
         
     Returns:
-        str: Text content after replacing all matches with 'replacement' if found any.
+        str: Cleaned text, stripped of leading and trailing spaces.
+            None if text is None, one of empty_texts, or nothing is left of it after cleaning.
         
     Notes:
-        Intended to be used only as a function created in sqlite for text preprocessing with queries.
+        Intended to be used as CLEAN_TEXT function created in sqlite, replaces 7 nested REGEX_REPLACE calls wrapped in TRIM
+        together with setting NULL before and after cleaning, so every row is written once.
     '''
-    if text is None:
-        return ''
-    else:
-        result = re.sub(pattern, replacement, text)
-        # order of parameters in regex_replace() is switched to better match REGEX_REPLACE or REGEXP_REPLACE
-        # that function in other sql databases
-        return result
-    
-def create_regex_replace(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> None:
+    if text is None or text in empty_texts:
+        return None
+    return clean_text_not_null(text) or None
+
+def clean_text_not_null(text: str) -> str:
     '''
-    Checks if REGEX_REPLACE function exists and works correctly in current sqlite connection.
+    Variant of clean_text() for columns declared NOT NULL, never returns None.
     
     Parameters:
-        conn (sqlite3.Connection): SQLite database connection.
-        cursor (sqlite3.Cursor): SQLite database cursor.
+        text (str): Text content to clean.
+        
+    Returns:
+        str: Cleaned text, stripped of leading and trailing spaces. Empty string if text is None or nothing is left of it.
         
     Notes:
-        - Function returns nothing
-        - Raises AssertionError if REGEX_REPLACE works incorrectly (for example by having wrong order of parameters)
+        Intended to be used as CLEAN_TEXT_NOT_NULL function created in sqlite. Comments and Replies declare
+        Text_content NOT NULL ON CONFLICT IGNORE, setting such column to NULL silently skips the whole row's UPDATE.
+        [deleted] and [removed] are cleaned like any other text there, which is what setting them to NULL first
+        amounted to on those tables.
     '''
-    try:
-        cursor.execute("SELECT REGEX_REPLACE('test', 'est', 'ry')")
-        result = cursor.fetchall()
-        assert result == [('try',)], (
-            "REGEX_REPLACE exists in this connection, but provided unexpected output.\n"
-            "Correct order of parameters: 'text', 'pattern', 'replacement'")
+    if text is None:
+        return ''
+    # literal prefilter, substring search is a single fast scan
+    patterns = cleaning_patterns_global if '.com' in text else cleaning_patterns_no_com_global
+    for pattern, replacement, required in patterns:
+        if required is None or required in text:
+            text = pattern.sub(replacement, text)
+    return text.strip(' ') # TRIM() in sqlite removes only spaces
 
-    except sqlite3.OperationalError as e:
-        if "no such function: REGEX_REPLACE" in str(e):
-            conn.create_function('REGEX_REPLACE', 3, regex_replace)
+def create_clean_text(conn: sqlite3.Connection) -> None:
+    '''
+    Creates CLEAN_TEXT and CLEAN_TEXT_NOT_NULL functions in current sqlite connection.
+    
+    Notes:
+        - Function returns nothing.
+        - Registered as deterministic, output depends only on the input text.
+    '''
+    conn.create_function('CLEAN_TEXT', 1, clean_text, deterministic=True)
+    conn.create_function('CLEAN_TEXT_NOT_NULL', 1, clean_text_not_null, deterministic=True)
+
+def add_cleaned_column(cursor: sqlite3.Cursor, table_name: str) -> None:
+    '''
+    Adds cleaned_column_name flag column (default 0) to the table and a partial index on its not cleaned rows,
+    does nothing if the column already exists.
+
+    Notes:
+        - Rows inserted later (e.g. incremental ingest) get the default 0 and are picked up by the next cleaning.
+        - The partial index holds only rows with flag 0, so it's nearly empty once everything is cleaned.
+    '''
+    if check_column_exist(cursor=cursor, check_dict={table_name: cleaned_column_name}):
+        return
+    cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN {cleaned_column_name} INTEGER DEFAULT 0;')
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{table_name}_{cleaned_column_name}
+        ON {table_name}({cleaned_column_name}) WHERE {cleaned_column_name} = 0;
+    """)
+
+def clean_column(cursor: sqlite3.Cursor, table_name: str, column_name: str) -> None:
+    '''
+    Cleans values of a column not cleaned yet with CLEAN_TEXT function, which has to exist in the connection (create_clean_text()),
+    and marks them in cleaned_column_name column (add_cleaned_column()).
+    
+    Notes:
+        - One write per row, CLEAN_TEXT returns NULL for [deleted], [removed] and empty results.
+        - Columns declared NOT NULL are cleaned with CLEAN_TEXT_NOT_NULL instead, a NULL would make SQLite skip
+            the row's UPDATE (ON CONFLICT IGNORE), leaving the text raw and the row flagged as not cleaned.
+        - CLEAN_TEXT is called only for texts it can change (clean_text_needed_sql), texts made only of letters,
+            digits and single inner spaces are kept as they are without going into Python.
+        - Cleaning isn't idempotent for every text (characters removed by a later pattern can form a new match
+            for an earlier one), the flag keeps each row from being cleaned twice.
+        - Rows the UPDATE skipped (e.g. by an ON CONFLICT IGNORE constraint) stay flagged 0 and would be retried
+            on every run without ever being written, their count is reported. The check reads only the partial index.
+        - Does not handle the transaction, meant to be called inside one.
+    '''
+    clean_function = 'CLEAN_TEXT_NOT_NULL' if column_not_null(cursor=cursor, table_name=table_name, column_name=column_name) else 'CLEAN_TEXT'
+    cursor.execute(f"""
+        UPDATE {table_name}
+        SET {column_name} = CASE WHEN {clean_text_needed_sql.format(column=column_name)}
+                                 THEN {clean_function}({column_name}) ELSE {column_name} END,
+            {cleaned_column_name} = 1
+        WHERE {cleaned_column_name} = 0;
+    """)
+    cursor.execute(f'SELECT COUNT(*) FROM {table_name} WHERE {cleaned_column_name} = 0;')
+    not_cleaned = cursor.fetchone()[0]
+    if not_cleaned:
+        print(f"{not_cleaned} rows of {table_name} were left not cleaned, their UPDATE was skipped by a constraint.")
 
 def preprocess_tables_text(conn: sqlite3.Connection, cursor: sqlite3.Cursor) -> None:
     '''
     Cleans tables: Posts, Comments, Replies in the SQLite database.
 
     Steps:
-    1. Creates a SQLite function 'REGEX_REPLACE' for further regex matching and replacing.
-    2. Assigns NULL to any [removed], [deleted] or empty string text contents.
+    1. Creates a SQLite function 'CLEAN_TEXT' applying all regex replacements in one call.
+    2. Assigns NULL to [removed], [deleted] or empty string text contents of Posts. Comments and Replies declare
+       Text_content NOT NULL, there these texts are cleaned like any other ('removed', 'deleted', '').
     3. Cleans text contents by removing URLs, HTML tags, unknown ASCII characters, emojis,
        and other characters that may not be suitable for NLP.
     4. Truncates multiple breaklines, whitespaces, punctuation marks to singular ones.
     5. Deletes entries if they do not have text information and are not necessary in relation to other tables.
+       Only Posts can match, Text_content of Comments and Replies is never NULL (see step 2).
+
+    Only rows not cleaned yet are processed (cleaned_column_name column, created on first run), so it can be re-run
+    after new rows are inserted.
 
     Parameters:
         conn (sqlite3.Connection): SQLite database connection.
         cursor (sqlite3.Cursor): SQLite database cursor.
 
     Notes:
-        - Column names are not parameterized, but table names are linked to the global variable table_names.
+        - Columns cleaned with CLEAN_TEXT come from the global variable table_columns_dict,
+            column names in DELETE conditions are not parameterized. Table names are linked to the global variable table_names.
         - The function modifies the database in-place and does not return any value.
     '''
     local_table_names = table_names # assuming order: Posts, Comments, Replies
-    create_regex_replace(conn=conn, cursor=cursor)
-    cursor.execute("BEGIN TRANSACTION;")
+    create_clean_text(conn=conn)
     try:
-        for table_name in local_table_names:
+        # IMMEDIATE takes the write lock up front, all UPDATEs and DELETEs below end with a single commit
+        with transaction(cursor=cursor, begin='BEGIN IMMEDIATE'):
+            for table_name in local_table_names:
+                add_cleaned_column(cursor=cursor, table_name=table_name)
+                clean_column(cursor=cursor, table_name=table_name, column_name=table_columns_dict[table_name])
+
+            # Deletion outside the loop to check on fully processed text contents
+            # Not updating Num_comments and Num_replies after deletion <- its information about raw state of post/comment
+            # Comments and Replies DELETEs match nothing with the NOT NULL schema of create_tables(), kept for tables without it
             cursor.execute("""
-                UPDATE {}
-                SET Text_content = NULL
-                WHERE Text_content IN ('[deleted]', '[removed]', '');
-            """.format(table_name))
-
-            cursor.execute(r"""
-                UPDATE {}
-                SET Text_content = TRIM(
-                REGEX_REPLACE(
-                    REGEX_REPLACE(
-                        REGEX_REPLACE(
-                            REGEX_REPLACE(
-                                REGEX_REPLACE(
-                                    REGEX_REPLACE(
-                                        REGEX_REPLACE(
-                                            Text_content,
-                                            "http\S+|www\S+|\S*\.com\S*|<.*?>|(?![\u2019\n])[^ -~]|[;:](?:-)?(?:([BCDOPVXbcdopvx30\(\)\[\]/\\\\*><])\\1*)|x200B.", ""),
-                                        "’", "'"),
-                                    "(?<![\.\s])\n+", ". "),
-                                "\n+", " "), 
-                            "[^0-9A-Za-z()\\'?!:,. +\\-\\x22]", ""), 
-                        "([.!?,-])\\1+", "\\1"), 
-                    "\s{{2,}}", " ")
-                );
-            """.format(table_name))
+                DELETE FROM {}
+                WHERE Num_comments = 0 AND Text_content IS NULL;
+            """.format(local_table_names[0]))
 
             cursor.execute("""
-                UPDATE {}
-                SET Text_content = NULL
-                WHERE Text_content = '';
-            """.format(table_name))
-
-        # Deletion outside the loop to check on fully processed text contents
-        # Not updating Num_comments and Num_replies after deletion <- its information about raw state of post/comment
-        cursor.execute("""
-            DELETE FROM {}
-            WHERE Num_comments = 0 AND Text_content IS NULL;
-        """.format(local_table_names[0]))
-
-        cursor.execute("""
-            DELETE FROM {}
-            WHERE Num_replies = 0 AND Text_content IS NULL;
-        """.format(local_table_names[1]))
-
-        cursor.execute("""
-            DELETE FROM {}
-            WHERE Text_content IS NULL;
-        """.format(local_table_names[2]))
-        
-        cursor.execute("COMMIT;")
+                DELETE FROM {}
+                WHERE Num_replies = 0 AND Text_content IS NULL;
+            """.format(local_table_names[1]))
+
+            cursor.execute("""
+                DELETE FROM {}
+                WHERE Text_content IS NULL;
+            """.format(local_table_names[2]))
     
     except sqlite3.Error as e:
         print("SQLite error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")  
     except Exception as e:
         print("Error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")
 
 def tokenize_and_json_serialize(nlp_model: spacy.lang.en.English, text: str) -> Tuple[str, str, str]:
     '''
@@ -186,57 +319,153 @@ def tokenize_and_json_serialize(nlp_model: spacy.lang.en.English, text: str) ->
     '''
     if text is None:
         return None, None, None
-    doc = nlp_model(text)
-    if doc.lang_ != 'en':
-        return None, None, None
-    raw_tokens = [token.text for token in doc]
-    lemma_lower_tokens = [token.lemma_.lower() for token in doc]
-    lemma_lower_stop_tokens = [token.lemma_.lower() for token in doc if token.text.lower() not in STOP_WORDS_SET and token.text not in punctuation]
+    return serialize_doc(nlp_model(text))
+
+def json_dumps(tokens: List[str]) -> str:
+    '''
+    Serializes list of tokens into compact JSON string, with orjson if it's installed, json otherwise (same output).
+    '''
+    if orjson is not None:
+        return orjson.dumps(tokens).decode()
+    return json_encoder_global.encode(tokens)
+
+def encode_tokens(tokens: List[str]) -> Union[str, bytes]:
+    '''
+    Encodes list of tokens for storage, JSON string or zlib compressed JSON bytes depending on tokens_compression_level.
+    '''
+    serialized = json_dumps(tokens)
+    if tokens_compression_level is None:
+        return serialized
+    return zlib.compress(serialized.encode(), tokens_compression_level)
+
+def tokens_load(value: Union[str, bytes, None]) -> List[str]:
+    '''
+    Decodes tokens stored by encode_tokens(), both JSON text and compressed BLOB values.
+
+    Returns:
+        List[str]: List of tokens, None if value is NULL (row without text).
+    '''
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = zlib.decompress(value)
+    return json.loads(value)
+
+def serialize_doc(doc: spacy.tokens.Doc) -> Tuple[str, str, str]:
+    '''
+    Serializes tokens of already processed text, see tokenize_and_json_serialize() for returned values.
+    '''
+    raw_tokens = []
+    lemma_lower_tokens = []
+    raw_append, lemma_append = raw_tokens.append, lemma_lower_tokens.append
+    # single pass over doc, iterating it creates new Token objects every time
+    for token in doc:
+        raw_append(token.text)
+        lemma_append(token.lemma_.lower())
+    # filtered from lists above - token.text / token.lemma_ build new strings on every access, lower() isn't repeated either
+    lemma_lower_stop_tokens = [lemma for text, lemma in zip(raw_tokens, lemma_lower_tokens)
+                               if text.lower() not in STOP_WORDS_SET and text not in punctuation_substrings]
     
-    raw_serialized = json.dumps(raw_tokens)
-    lemma_lower_serialized = json.dumps(lemma_lower_tokens)
-    lemma_lower_stop_serialized = json.dumps(lemma_lower_stop_tokens)
+    raw_serialized = encode_tokens(raw_tokens)
+    lemma_lower_serialized = encode_tokens(lemma_lower_tokens)
+    lemma_lower_stop_serialized = encode_tokens(lemma_lower_stop_tokens)
     
     return raw_serialized, lemma_lower_serialized, lemma_lower_stop_serialized
 
-def create_columns_insert_tokens(cursor: sqlite3.Cursor, table_name: str, serialized_values: List[Tuple[str, str, str]]) -> None:
+def create_columns_insert_tokens(cursor: sqlite3.Cursor, table_name: str, serialized_values: Iterable[Tuple[str, str, str, str]]) -> None:
     '''
     Creates 3 new columns for different versions of serialized tokens and populates them.
     
     Parameters:
         cursor (sqlite3.Cursor): Cursor object used for querying.
         table_name (str): Name of a table that will be altered and populated.
-        serialized_values (List[Tuple[str, str, str]]): Values which will be inserted into a table.
+        serialized_values (Iterable[Tuple[str, str, str, str]]): Values which will be inserted into a table, 3 serialized
+            token lists followed by Id of the row. Can be a generator, it's consumed only after the columns are created.
         
     Notes:
         - Function modifies table in-place and does not return any value.
         - This function will only create missing columns <-> won't create any if there already are these 3 exact columns in a table.
         - Function overwrites values that already exist in those columns.
+        - Values are written in batches of tokens_per_commit rows, each in its own transaction. On error only
+            the current batch is rolled back, batches committed before it are kept.
     '''
     new_columns = new_columns_global
-    cursor.execute("BEGIN TRANSACTION;")
     try:
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        current_column_list = [col[1] for col in cursor.fetchall()]
-        for column_name in new_columns:
-            if column_name in current_column_list:
-                continue
-            else:
+        with transaction(cursor=cursor):
+            current_columns = table_columns(cursor=cursor, table_name=table_name)
+            for column_name in (column for column in new_columns if column not in current_columns):
                 cursor.execute(f'''
                     ALTER TABLE {table_name}
                     ADD COLUMN {column_name} TEXT;
                 ''')
         
-        query = f'UPDATE {table_name} SET ({", ".join(new_columns)}) = ({", ".join(["?" for _ in range(len(new_columns))])}) WHERE Id = ?;'
-        cursor.executemany(query, serialized_values)
-        cursor.execute("COMMIT;")
+        # plain assignments instead of row value (a, b, c) = (?, ?, ?), which needs SQLite 3.15+
+        query = f'UPDATE {table_name} SET {", ".join(f"{column} = ?" for column in new_columns)} WHERE Id = ?;'
+        values_iterator = iter(serialized_values)
+        # batch is built (tokenized) outside of the transaction, write lock is held only for executemany
+        while batch := list(islice(values_iterator, tokens_per_commit)):
+            with transaction(cursor=cursor):
+                cursor.executemany(query, batch)
         
     except sqlite3.Error as e:
         print("SQLite error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")
     except Exception as e:
         print("Error:", e.__class__.__name__, "\n", e)
-        cursor.execute("ROLLBACK;")
+
+def iter_serialized_tokens(cursor: sqlite3.Cursor,
+                           nlp_model: spacy.lang.en.English,
+                           table_name: str,
+                           column_name: str,
+                           tokens_cache: 'OrderedDict[str, Tuple[str, str, str]]' = None) -> Generator[Tuple[str, str, str, str], None, None]:
+    '''
+    Yields serialized tokens (see serialize_doc()) followed by Id for every row of a table, rows are read from the cursor
+    only as they're needed.
+
+    Parameters:
+        tokens_cache (OrderedDict[str, Tuple[str, str, str]]): LRU cache of serialized tokens of already processed texts,
+            updated in-place (hits are moved to the end, least recently used entry is popped from the front).
+            Can be shared between calls (tables), new one is used if not given.
+
+    Notes:
+        - Rows without text don't go through spaCy at all, their tokens are NULL.
+        - Texts are processed in batches of tokenize_batch_size with nlp_model.pipe(), in tokenize_n_process processes
+            if the table has at least tokenize_multiprocess_min_rows texts, in the main process otherwise.
+        - Texts found in tokens_cache are passed to spaCy as empty strings and their cached tokens are used.
+            Repeats of a text still in the pipeline (within a few batches) are processed again, the result is the same.
+        - The cursor is used for reading only, writes have to go through another cursor while the generator is consumed.
+    '''
+    if tokens_cache is None:
+        tokens_cache = OrderedDict()
+
+    def texts() -> Generator[Tuple[str, Tuple[str, Tuple[str, str, str]]], None, None]:
+        # context carries cached tokens, None -> the text has to be processed
+        for id_key, text_block in cursor:
+            cached = tokens_cache.get(text_block)
+            if cached is None:
+                yield text_block, (id_key, None)
+            else:
+                tokens_cache.move_to_end(text_block)
+                yield '', (id_key, cached)
+
+    cursor.execute(f"SELECT Id FROM {table_name} WHERE {column_name} IS NULL;")
+    yield from ((None, None, None, id_key) for id_key, in cursor)
+    texts_count = cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE {column_name} IS NOT NULL;").fetchone()[0]
+    n_process = tokenize_n_process if texts_count >= tokenize_multiprocess_min_rows else 1
+    cursor.execute(f"SELECT Id, {column_name} FROM {table_name} WHERE {column_name} IS NOT NULL;")
+    # texts go through spaCy in batches (nlp.pipe) instead of one nlp_model() call per row
+    docs = nlp_model.pipe(texts(),
+                          as_tuples=True,
+                          batch_size=tokenize_batch_size,
+                          n_process=n_process)
+    for doc, (id_key, serialized) in docs:
+        if serialized is None:
+            serialized = serialize_doc(doc)
+            if tokens_cache_size > 0 and len(doc.text) <= tokens_cache_max_text_length:
+                # repeats still in the pipeline when the text got cached just replace the value
+                if doc.text not in tokens_cache and len(tokens_cache) >= tokens_cache_size:
+                    tokens_cache.popitem(last=False) # least recently used entry
+                tokens_cache[doc.text] = serialized
+        yield serialized + (id_key,)
 
 def main_loop_for_tokenizing(cursor: sqlite3.Cursor,
                              nlp_model: spacy.lang.en.English,
@@ -251,24 +480,22 @@ def main_loop_for_tokenizing(cursor: sqlite3.Cursor,
                                    
     Notes:
         - Returns nothing. Gathers text blocks/columns to use for functions:
-            tokenize_and_json_serialize() and create_columns_insert_tokens().
-        - Raises AssertionError when the length of serialized_values do not match length of a table.
+            iter_serialized_tokens() and create_columns_insert_tokens().
+        - Rows are streamed from a second cursor through spaCy straight into UPDATEs, neither texts nor tokens
+            of a whole table are held in memory.
     '''
-    
+    read_cursor = cursor.connection.cursor() # SELECT stays open while UPDATEs go through cursor
+    tokens_cache = OrderedDict() # shared by all tables, replies often repeat texts of comments
     for table_name, column_list in table_columns_dict.items():
-        serialized_tokens = []
         column_name = column_list[0]
-        cursor.execute(f"SELECT Id, {column_name} FROM {table_name};")
-        fetched_results = cursor.fetchall()
-        for id_key, text_block in fetched_results:
-            serialized_tokens.append(tokenize_and_json_serialize(nlp_model=nlp_model, text=text_block) + (id_key,))
-            
-        assert len(serialized_tokens) == len(fetched_results), (
-            'Mismatch of lengths between retrieved serialized tokens and table size.\n'
-            f'{len(serialized_tokens) = }, {len(fetched_results) = }')
         create_columns_insert_tokens(cursor=cursor,
                                      table_name=table_name,
-                                     serialized_values=serialized_tokens)
+                                     serialized_values=iter_serialized_tokens(cursor=read_cursor,
+                                                                              nlp_model=nlp_model,
+                                                                              table_name=table_name,
+                                                                              column_name=column_name,
+                                                                              tokens_cache=tokens_cache))
+    read_cursor.close()
     
 def main():
     # Connection and paths
@@ -277,8 +504,11 @@ def main():
     data_dir = os.path.join(current_dir, '..', data_directory_name) # assuming Data and PyScripts are both in main
     database_name = input('Input database name (with file extension) to start cleaning: ')
     database_path = os.path.join(data_dir, database_name)
-    conn = sqlite3.connect(database_path)
+    # isolation_level=None -> no implicit transactions, every write is wrapped in explicit BEGIN/COMMIT
+    conn = sqlite3.connect(database_path, isolation_level=None)
     cursor = conn.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(f'PRAGMA {pragma};')
 
     assert check_column_exist(cursor=cursor, check_dict=table_columns_dict), (
         f'At least one table doesn\'t have text content column: {text_content_column_name}')
@@ -288,10 +518,20 @@ def main():
 
     # Adding tokenized columns
     main_loop_for_tokenizing(cursor=cursor,
-                             nlp_model=nlp_model,
-                             table_columns_dict=table_columns_dict)
+                             nlp_model=load_nlp_model(),
+                             table_columns_dict={table: [column] for table, column in table_columns_dict.items()})
 
     conn.close()
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if '--profile' in sys.argv[1:]:
+        # time split between clean_text() (re), spaCy and sqlite3 executemany/COMMIT, both passes rewrite every row
+        # so they're bound by memory and disk rather than CPU. Time of spaCy worker processes (tokenize_n_process > 1)
+        # shows up only as waiting in the main process, profile with tokenize_n_process = 1 to see inside of it
+        import cProfile
+        import pstats
+        with cProfile.Profile() as profiler:
+            main()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(profile_top_functions)
+    else:
+        main()
\ No newline at end of file